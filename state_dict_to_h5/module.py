@@ -1,11 +1,167 @@
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import zlib
 import h5py
 import torch
 import numpy as np
 
+# arrays larger than this many bytes are stored chunked and compressed, smaller ones are stored contiguously
+compressionThreshold = 64 * 1024
+
+# scalars are stored as attributes of their parent group until it holds this many attributes, and as datasets afterwards.
+# Attribute access slows down considerably on groups with very large numbers of attributes.
+attributeLimit = 64
+
+# target size in bytes of the chunks of arrays compressed by the thread pool
+parallelChunkSize = 1024 * 1024
+
+@functools.lru_cache(maxsize=4096)
+def _mangleStr(key):
+    """mangles a string key. Cached, since state dictionaries repeat the same names across many layers."""
+    if key[:7] == "__int__":
+        raise ValueError("Keys starting with __int__ are reserved for internal use")
+    elif key == "__emptyString__":
+        raise ValueError("__emptyString__ is reserved for internal use")
+    elif key == "__packed__":
+        raise ValueError("__packed__ is reserved for internal use")
+    elif key == "":
+        return "__emptyString__"
+    return key
+
+def _mangleInt(key):
+    return "__int__" + str(key)
+
+# exact key type -> mangling function, avoiding a chain of isinstance checks for every key
+_keyManglers = {int: _mangleInt, str: _mangleStr}
+
+def _mangleKey(key):
+    """converts a dictionary key to the name of the corresponding HDF5 group, dataset or attribute."""
+    mangler = _keyManglers.get(type(key))
+    if mangler is not None:
+        return mangler(key)
+    # subclasses of int and str, such as enums, take the slow path
+    if isinstance(key, int):
+        return _mangleInt(key)
+    elif isinstance(key, str):
+        return _mangleStr(key)
+    raise ValueError("Keys must be strings or ints")
+
+@functools.lru_cache(maxsize=4096)
+def _unmangleKey(name):
+    """converts the name of an HDF5 group, dataset or attribute back to the dictionary key it was created from."""
+    if name == "__emptyString__":
+        return ""
+    elif name[:7] == "__int__":
+        return int(name[7:])
+    return name
+
+# exact container type -> type hint. OrderedDict is listed, since it is the type of all PyTorch state dictionaries.
+_containerTypes = {dict: "dict", collections.OrderedDict: "dict", list: "list", tuple: "tuple"}
+
+def _containerType(data):
+    """returns the type hint of a data structure that is stored as an HDF5 group, or None for leaves."""
+    containerType = _containerTypes.get(type(data))
+    if containerType is not None:
+        return containerType
+    if type(data) is torch.Tensor or type(data) in _packers:
+        return None
+    # other subclasses of the container types take the slow path
+    if isinstance(data, dict):
+        return "dict"
+    elif isinstance(data, list):
+        return "list"
+    elif isinstance(data, tuple):
+        return "tuple"
+    return None
+
+def _children(data):
+    """yields the HDF5 name and value of every element of a dictionary, list or tuple."""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield _mangleKey(key), value
+    elif isinstance(data, list) or isinstance(data, tuple):
+        for idx, value in enumerate(data):
+            yield str(idx), value
+
+def _storageDtype(dtype, tensorStorageDtype):
+    """returns the dtype a tensor of the given dtype is written to the file as."""
+    if tensorStorageDtype is not None and dtype == torch.float32:
+        return tensorStorageDtype
+    return dtype
+
+def _tensorToArray(tensor, tensorStorageDtype):
+    """converts a CPU tensor to the numpy array written to the file."""
+    tensor = tensor.to(_storageDtype(tensor.dtype, tensorStorageDtype))
+    if tensor.dtype == torch.bfloat16:
+        # numpy has no bfloat16 type, so the raw bits are stored instead
+        return tensor.view(torch.int16).numpy()
+    return tensor.numpy()
+
+def _dtypeHints(dtype, tensorStorageDtype):
+    """returns the attributes marking tensors that are not stored in their original dtype, or an empty dictionary."""
+    storageDtype = _storageDtype(dtype, tensorStorageDtype)
+    if storageDtype == dtype and dtype != torch.bfloat16:
+        return {}
+    return {"torch_dtype": str(dtype)[6:], "storage_dtype": str(storageDtype)[6:]}
+
+def _restoreDtype(tensor, attrs):
+    """converts a loaded tensor back to its original dtype, using the attributes created by _dtypeHints."""
+    if "storage_dtype" not in attrs:
+        return tensor
+    if attrs["storage_dtype"] == "bfloat16":
+        tensor = tensor.view(torch.bfloat16)
+    return tensor.to(getattr(torch, attrs["torch_dtype"]))
+
+def _packNone(data):
+    return h5py.Empty("f"), "None"
+
+def _packBool(data):
+    return np.array(data), "bool"
+
+def _packInt(data):
+    return np.array(data), "int"
+
+def _packFloat(data):
+    return np.array(data), "float"
+
+def _packStr(data):
+    return data.encode("utf-8"), "str"
+
+# exact leaf type -> function returning the data written to the file and its type hint.
+# bool has to precede int, since the table is also searched with isinstance for subclasses.
+_packers = {type(None): _packNone, bool: _packBool, int: _packInt, float: _packFloat, str: _packStr}
+
+# exact types of the leaves stored as attributes of their parent group
+_scalarTypes = {bool, int, float}
+
+def _isScalar(data):
+    """returns whether data is stored as an attribute of its parent group."""
+    if type(data) in _scalarTypes:
+        return True
+    if type(data) is torch.Tensor or type(data) in _packers:
+        return False
+    # subclasses of the scalar types, such as enums, take the slow path
+    return isinstance(data, (bool, int, float))
+
+def _removeScalar(position, name):
+    """removes a scalar stored as an attribute of the group position, and returns whether there was one."""
+    if "__type__" + name not in position.attrs:
+        return False
+    del position.attrs["__value__" + name]
+    del position.attrs["__type__" + name]
+    return True
+
+def _joinPath(path, name):
+    """appends an HDF5 name to a path relative to the storage root, as used in the layout of packed tensors."""
+    return path + "/" + name if path else name
+
 class DictStorage:
     """Class for handling PyTorch state dictionaries and other nested data structures in an HDF5 file"""
 
-    def __init__(self, file, groups:list = [], torchDevice:str = "cpu"):
+    def __init__(self, file, groups:list = [], torchDevice:str = "cpu", verbose:bool = False, compression:str = "lzf", packSmallTensors:bool = False, tensorStorageDtype:torch.dtype = None, writeThreads:int = None):
         """
         file: name of the .hdf5 file
         
@@ -13,49 +169,238 @@ class DictStorage:
         with each string being the name of a subgroup. Leave empty to save to the root of the file.
         
         torchDevice: the torch.device the tensors will be sent to when loading the model from the file.
+        
+        verbose: print every node and key written during serialization. Useful for debugging, but slow on large inputs.
+        
+        compression: the HDF5 filter used for arrays larger than 64 KiB, e.g. "lzf" or "gzip". Set to None to store all data uncompressed.
+        
+        packSmallTensors: store tensors of up to 64 KiB concatenated into a single dataset per dtype, instead of one dataset each.
+        This greatly reduces the number of HDF5 objects for optimizer states and normalization buffers.
+        
+        tensorStorageDtype: set to torch.float16 or torch.bfloat16 to store float32 tensors in half precision, halving their size on disk.
+        They are converted back to float32 when loading.
+        
+        writeThreads: number of threads compressing large arrays in parallel when using "gzip" compression. Defaults to the number of CPU cores.
+        Other filters run inside the HDF5 library, which h5py only allows to be used by one thread at a time.
         """
+        if tensorStorageDtype not in (None, torch.float16, torch.bfloat16):
+            raise ValueError("tensorStorageDtype must be None, torch.float16 or torch.bfloat16")
         self.group = file
         for i in groups:
-            if i not in self.group:
-                self.group.create_group(i)
-            self.group = self.group[i]
+            group = self.group.get(i)
+            self.group = group if group is not None else self.group.create_group(i, track_order=False)
         self.torchDevice = torchDevice
+        self.verbose = verbose
+        self.compression = compression
+        self.packSmallTensors = packSmallTensors
+        self.tensorStorageDtype = tensorStorageDtype
+        self.writeThreads = writeThreads if writeThreads is not None else os.cpu_count() or 1
+        # thread pool shared by all arrays compressed during a fromDict call
+        self._executor = None
+    
+    @classmethod
+    def open(cls, path:str, mode:str = "a", chunkCacheSize:int = 256 * 1024 * 1024, chunkCacheSlots:int = 10007, libver:str = "latest", **kwargs):
+        """
+        opens the .hdf5 file at path with settings tuned for large state dictionaries, and returns a DictStorage for it.
+        Any further keyword arguments are passed on to the constructor.
+        
+        mode: the h5py file mode, e.g. "r", "w" or "a".
+        
+        chunkCacheSize: size of the chunk cache in bytes. The h5py default of 1 MiB is smaller than a single chunk of most
+        weight tensors, which causes the cache to thrash when reading or writing compressed data.
+        
+        chunkCacheSlots: number of hash table slots of the chunk cache. Should be a prime number, and larger than the number of
+        chunks fitting into the cache, about 256 with the default size and 1 MiB chunks. The table is allocated every time a
+        dataset is opened, so much larger values slow down files with many datasets.
+        
+        libver: the oldest HDF5 file format version used for the file. "latest" enables the newer, faster object header
+        and group layouts, but the file can then only be read by recent versions of the HDF5 library.
+        
+        New files use paged file space management, which keeps repeated overwrites from fragmenting the file.
+        
+        The file is closed again by calling close() on the returned object.
+        """
+        options = {}
+        if mode in ("w", "w-", "x") or (mode == "a" and not os.path.exists(path)):
+            # the file space strategy can only be set when the file is created
+            options = {"fs_strategy": "page", "fs_persist": True, "fs_page_size": 4096}
+        file = h5py.File(path, mode, rdcc_nbytes=chunkCacheSize, rdcc_nslots=chunkCacheSlots, libver=libver, track_order=False, **options)
+        return cls(file, **kwargs)
+    
+    @staticmethod
+    def repack(path:str):
+        """
+        rewrites the closed .hdf5 file at path, releasing the space left unused by deleted and overwritten elements.
+        HDF5 does not shrink files on its own, so files edited through insert and delete many times keep growing otherwise.
+        """
+        tempPath = path + ".repack"
+        with h5py.File(path, "r") as source:
+            options = {}
+            createOptions = source.id.get_create_plist()
+            if createOptions.get_file_space_strategy()[0] == h5py.h5f.FSPACE_STRATEGY_PAGE:
+                options = {"fs_strategy": "page", "fs_persist": True, "fs_page_size": createOptions.get_file_space_page_size()}
+            with h5py.File(tempPath, "w", libver=source.libver, track_order=False, **options) as target:
+                for name in source:
+                    source.copy(source[name], target, name)
+                for name, value in source.attrs.items():
+                    target.attrs[name] = value
+        os.replace(tempPath, path)
+    
+    def close(self):
+        """closes the file the data is stored in."""
+        self.group.file.close()
+    
+    def _filterOptions(self, data):
+        """returns the chunking and compression arguments for create_dataset, depending on the size of the data to be written."""
+        if self.compression is None or not isinstance(data, np.ndarray) or data.nbytes <= compressionThreshold:
+            return {}
+        return {"chunks": True, "compression": self.compression, "shuffle": True}
+    
+    def _createArray(self, position, name, data):
+        """creates a dataset for a numeric numpy array with explicit shape and dtype, and writes the array buffer to it directly.
+        This bypasses the type inference and temporary copies of create_dataset(data=...)."""
+        filterOptions = self._filterOptions(data)
+        if filterOptions.get("compression") == "gzip" and self.writeThreads > 1 and data.ndim > 0 and data.nbytes // data.shape[0] < 2**31:
+            return self._createArrayParallel(position, name, data)
+        # Uncompressed arrays are stored contiguously, where a single H5Dwrite of the whole buffer is the cheapest path.
+        # Filters other than gzip run inside the HDF5 library, so their chunks cannot be compressed by a thread pool
+        # and written with write_direct_chunk like in _createArrayParallel.
+        dataset = position.create_dataset(name, shape=data.shape, dtype=data.dtype, **filterOptions)
+        if data.size > 0:
+            dataset.id.write(h5py.h5s.ALL, h5py.h5s.ALL, np.ascontiguousarray(data))
+        return dataset
+    
+    def _createArrayParallel(self, position, name, data):
+        """creates a gzip compressed dataset for a numpy array, compressing its chunks with a thread pool.
+        The chunks are shuffled and deflated in the same way as the HDF5 filter pipeline would, but by numpy and zlib, which release the GIL.
+        They are then written to the file as they are, using direct chunk writes."""
+        data = np.ascontiguousarray(data)
+        rows = min(data.shape[0], max(1, parallelChunkSize // (data.nbytes // data.shape[0])))
+        dataset = position.create_dataset(name, shape=data.shape, dtype=data.dtype, chunks=(rows,) + data.shape[1:],
+                                          compression="gzip", shuffle=True)
+        level = dataset.compression_opts
+        def compress(start):
+            chunk = data[start:start + rows]
+            if chunk.shape[0] < rows:
+                # chunks at the edge of the dataset are stored at full size
+                chunk = np.concatenate([chunk, np.zeros((rows - chunk.shape[0],) + data.shape[1:], dtype=data.dtype)])
+            return zlib.compress(chunk.view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes(), level)
+        starts = range(0, data.shape[0], rows)
+        if self._executor is not None:
+            chunks = self._executor.map(compress, starts)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.writeThreads) as executor:
+                chunks = list(executor.map(compress, starts))
+        for start, chunk in zip(starts, chunks):
+            dataset.id.write_direct_chunk((start,) + (0,) * (data.ndim - 1), chunk)
+        return dataset
+    
+    def _toTensor(self, data):
+        """wraps an array read from the file as a tensor without copying it, and moves it to the target device."""
+        return torch.from_numpy(np.asarray(data)).to(self.torchDevice, non_blocking=True)
+    
+    def _packedTensor(self, keys:list, remove:bool = False):
+        """looks up a tensor stored in the __packed__ group, and optionally removes it from the layout. Returns None if there is no such tensor."""
+        packedGroup = self.group.get("__packed__")
+        if packedGroup is None:
+            return None
+        path = "/".join(keys)
+        # layouts not containing the encoded path as a substring are skipped without parsing them
+        encodedPath = json.dumps(path).encode("utf-8")
+        for group in packedGroup.values():
+            layout = group["layout"][()]
+            if encodedPath not in layout:
+                continue
+            layout = json.loads(layout)
+            if path in layout:
+                offset, shape = layout[path]
+                data = group["data"][offset:offset + int(np.prod(shape))].reshape(shape)
+                if remove:
+                    del layout[path]
+                    del group["layout"]
+                    group.create_dataset("layout", data=json.dumps(layout).encode("utf-8"))
+                return data
+        return None
+    
+    def _hasPackedTensors(self, keys:list):
+        """returns whether any tensor below the group at keys is stored in the __packed__ group."""
+        packedGroup = self.group.get("__packed__")
+        if packedGroup is None:
+            return False
+        prefix = "/".join(keys) + "/"
+        # as in _packedTensor, layouts not containing the encoded prefix are skipped without parsing them
+        encodedPrefix = json.dumps(prefix).encode("utf-8")[:-1]
+        for group in packedGroup.values():
+            layout = group["layout"][()]
+            if encodedPrefix in layout and any(i.startswith(prefix) for i in json.loads(layout)):
+                return True
+        return False
     
     def fetch(self, keys:list):
         """fetch an individual dictionary element."""
         position = self.group
-        for i in keys:
-            if i not in position:
+        for i in keys[:-1]:
+            position = position.get(i)
+            if position is None:
+                raise KeyError("Key not found")
+        if "__type__" + keys[-1] in position.attrs:
+            return position.attrs["__value__" + keys[-1]]
+        dataset = position.get(keys[-1])
+        if dataset is None:
+            dataset = self._packedTensor(keys)
+            if dataset is None:
                 raise KeyError("Key not found")
-            position = position[i]
-        return position[()]
+            return dataset
+        return dataset[()]
     
     def insert(self, keys:list, value):
         """insert an individual dictionary element."""
         position = self.group
         for i in keys[:-1]:
-            if i not in position:
-                position.create_group(i)
-            position = position[i]
-        if keys[-1] in position:
+            group = position.get(i)
+            position = group if group is not None else position.create_group(i, track_order=False)
+        existing = position.get(keys[-1])
+        if isinstance(existing, h5py.Dataset) and isinstance(value, np.ndarray) and existing.shape == value.shape and existing.dtype == value.dtype:
+            # overwrite the data in place instead of deleting and recreating the dataset, which would fragment the file.
+            # Dtype hints describe the previous contents, and are dropped just like when the dataset is recreated.
+            for i in ("torch_dtype", "storage_dtype"):
+                if i in existing.attrs:
+                    del existing.attrs[i]
+            if value.size > 0:
+                existing.write_direct(np.ascontiguousarray(value))
+            return
+        if existing is not None:
             del position[keys[-1]]
-        position.create_dataset(keys[-1], data=value)
+        elif not _removeScalar(position, keys[-1]):
+            # the element can only be a packed tensor if it is stored neither as a link nor as an attribute
+            self._packedTensor(keys, remove=True)
+        if isinstance(value, np.ndarray) and value.dtype.kind in "biufc":
+            self._createArray(position, keys[-1], value)
+        else:
+            position.create_dataset(keys[-1], data=value)
         
     def delete(self, keys:list, recursive:bool = False):
         """delete a group from the file, with the option to recursively delete its children."""
         position = self.group
         for i in keys[:-1]:
-            if i not in position:
+            position = position.get(i)
+            if position is None:
                 raise KeyError("Key not found")
-            position = position[i]
-        if keys[-1] not in position:
+        if "__type__" + keys[-1] in position.attrs:
+            del position.attrs["__value__" + keys[-1]]
+            del position.attrs["__type__" + keys[-1]]
+        elif keys[-1] in position:
+            del position[keys[-1]]
+        elif self._packedTensor(keys, remove=True) is None:
             raise KeyError("Key not found")
-        del position[keys[-1]]
         if recursive:
-            while len(position.keys()) == 0:
-                newPosition = position.parent
-                del position
-                position = newPosition
+            # groups left without elements are deleted as well, up to the storage root. Scalar attributes and
+            # packed tensors count as elements, even though they are not links of the group.
+            for depth in range(len(keys) - 1, 0, -1):
+                if len(position) > 0 or any(i.startswith("__type__") for i in position.attrs) or self._hasPackedTensors(keys[:depth]):
+                    break
+                position = position.parent
+                del position[keys[depth - 1]]
         
     def toDict(self):
         """deserializes the file and returns the original data structure used during serialization."""
@@ -69,125 +414,286 @@ class DictStorage:
             elif data.attrs["type"] == "str":
                 return data[()].decode("utf-8")
             elif data.attrs["type"] == "tensor":
-                return torch.tensor(data[()], device=self.torchDevice)
+                return _restoreDtype(self._toTensor(data[()]), data.attrs)
+            elif data.attrs["type"] in ("packed_list", "packed_tuple"):
+                if data.attrs["elem_type"] == "tensor":
+                    target = list(_restoreDtype(self._toTensor(data[()]), data.attrs).unbind(0))
+                else:
+                    target = data[()].tolist()
+                if data.attrs["type"] == "packed_tuple":
+                    target = tuple(target)
+                return target
             else:
                 print("WARNING: unknown data type hint in loaded file, deserialization may not produce expected results")
                 return data[()]
-        def recursiveFetch(position):
+        def unpackScalar(position, name):
+            value = position.attrs["__value__" + name]
+            if position.attrs["__type__" + name] == "bool":
+                return bool(value)
+            return value.item()
+        # when loading to a CUDA device, tensors are only collected during the tree walk, and read in one batch afterwards
+        deferred = [] if torch.device(self.torchDevice).type == "cuda" else None
+        def load(dataset, target, slot):
+            if deferred is not None and dataset.attrs["type"] == "tensor":
+                deferred.append((dataset, target, slot))
+                target[slot] = None
+            else:
+                target[slot] = unpack(dataset)
+        # small tensors may be stored concatenated in the __packed__ group. They are sorted by the path of their parent group,
+        # and inserted into the matching containers during the tree walk.
+        packed = {}
+        packedGroup = self.group.get("__packed__")
+        if packedGroup is not None:
+            for group in packedGroup.values():
+                data = group["data"][()]
+                for path, (offset, shape) in json.loads(group["layout"][()]).items():
+                    parentPath, _, name = path.rpartition("/")
+                    tensor = self._toTensor(data[offset:offset + int(np.prod(shape))].reshape(shape))
+                    tensor = _restoreDtype(tensor, group.attrs)
+                    packed.setdefault(parentPath, {})[name] = tensor
+        # the tree is walked with an explicit stack instead of recursion, so arbitrarily deep structures can be loaded.
+        # Containers are created top-down and attached to their parent right away; tuples are built as lists first
+        # and converted once all of their children are complete.
+        root = [None]
+        tuples = []
+        stack = [(self.group, root, 0, "")]
+        while stack:
+            position, parent, slot, path = stack.pop()
+            # scalar leaves are stored as attributes of their parent group, alongside a type hint
+            scalars = [i[8:] for i in position.attrs if i.startswith("__type__")]
+            tensors = packed.get(path, {})
             if position.attrs["type"] in ("list", "tuple"):
-                target = []
-                for i in position:
-                    if isinstance(position[i], h5py.Group):
-                        target.append(recursiveFetch(position[i]))
+                size = len(position) + len(scalars) + len(tensors)
+                if path == "" and packedGroup is not None:
+                    size -= 1
+                target = [None] * size
+                for i, tensor in tensors.items():
+                    target[int(i)] = tensor
+                for i, child in position.items():
+                    if i == "__packed__":
+                        continue
+                    if isinstance(child, h5py.Group):
+                        stack.append((child, target, int(i), _joinPath(path, i)))
                     else:
-                        target.append(unpack(position[i]))
+                        load(child, target, int(i))
+                for i in scalars:
+                    target[int(i)] = unpackScalar(position, i)
                 if position.attrs["type"] == "tuple":
-                    target = tuple(target)
+                    tuples.append((parent, slot, target))
             else:
                 target = {}
-                for i in position.keys():
-                    if i == "__emptyString__":
-                        iOut = ""
-                    elif i.startswith("__int__"):
-                        iOut = int(i[7:])
+                for i, tensor in tensors.items():
+                    target[_unmangleKey(i)] = tensor
+                for i, child in position.items():
+                    if i == "__packed__":
+                        continue
+                    if isinstance(child, h5py.Group):
+                        stack.append((child, target, _unmangleKey(i), _joinPath(path, i)))
                     else:
-                        iOut = i
-                    if isinstance(position[i], h5py.Group):
-                        target[iOut] = recursiveFetch(position[i])
-                    else:
-                        target[iOut] = unpack(position[i])
-            
-            return target
-        return recursiveFetch(self.group)
+                        load(child, target, _unmangleKey(i))
+                for i in scalars:
+                    target[_unmangleKey(i)] = unpackScalar(position, i)
+            parent[slot] = target
+        if deferred:
+            # the tensors are read directly into one pinned host buffer without intermediate arrays,
+            # and copied to the device asynchronously with a single synchronization
+            sizes = [i.size * i.dtype.itemsize for i, _, _ in deferred]
+            offsets = np.cumsum([0] + [(i + 63) // 64 * 64 for i in sizes])
+            buffer = torch.empty(int(offsets[-1]), dtype=torch.uint8, pin_memory=True).numpy()
+            for (dataset, target, slot), size, offset in zip(deferred, sizes, offsets):
+                view = buffer[offset:offset + size].view(dataset.dtype).reshape(dataset.shape)
+                if size > 0:
+                    dataset.read_direct(view)
+                target[slot] = _restoreDtype(self._toTensor(view), dataset.attrs)
+            torch.cuda.synchronize(self.torchDevice)
+        for parent, slot, target in reversed(tuples):
+            parent[slot] = tuple(target)
+        return root[0]
         
     
     def fromDict(self, dictionary):
         """serializes a dictionary, or other data structure, to the location in the file specified during initialisation."""
         def pack(data):
-            if data is None:
-                outData = np.array([])
-                outDType = "None"
-            elif isinstance(data, torch.Tensor):
-                outData = data.cpu().numpy()
-                outDType = "tensor"
-            elif isinstance(data, bool):
-                outData = np.array(data)
-                outDType = "bool"
-            elif isinstance(data, float):
-                outData = np.array(data)
-                outDType = "float"
-            elif isinstance(data, int):
-                outData = np.array(data)
-                outDType = "int"
-            elif isinstance(data, str):
-                outData = data.encode("utf-8")
-                outDType = "str"
+            packer = _packers.get(type(data))
+            if packer is not None:
+                return packer(data)
+            if isinstance(data, torch.Tensor):
+                return _tensorToArray(staged.get(id(data), data).detach().cpu().contiguous(), self.tensorStorageDtype), "tensor"
+            # subclasses of the basic types, such as enums, take the slow path
+            for dataType, packer in _packers.items():
+                if isinstance(data, dataType):
+                    return packer(data)
+            raise ValueError("Invalid data type for serialization")
+        def isPackable(data):
+            # sequences of scalars of one type, or of small tensors sharing shape and dtype, are stored as a single array.
+            # Larger tensors are stored individually, since stacking them would hold a second copy of all of them in memory.
+            if len(data) == 0:
+                return False
+            first = data[0]
+            if type(first) in (bool, float):
+                return all(type(i) is type(first) for i in data)
+            elif type(first) is int:
+                return all(type(i) is int and -2**63 <= i < 2**63 for i in data)
+            elif isinstance(first, torch.Tensor):
+                if first.numel() * first.element_size() > compressionThreshold:
+                    return False
+                return all(isinstance(i, torch.Tensor) and i.shape == first.shape and i.dtype == first.dtype for i in data)
+            return False
+        def write(position, name, data):
+            if _isScalar(data) and len(position.attrs) < attributeLimit:
+                # scalars are stored as attributes of the parent group, avoiding the overhead of a dataset per value
+                outData, outDType = pack(data)
+                position.attrs["__value__" + name] = outData
+                position.attrs["__type__" + name] = outDType
+                return
+            if isinstance(data, list) or isinstance(data, tuple):
+                if isinstance(data[0], torch.Tensor):
+                    outData = np.stack([pack(i)[0] for i in data])
+                    elemType = "tensor"
+                else:
+                    outData = np.array(data)
+                    elemType = type(data[0]).__name__
+                outDType = "packed_" + type(data).__name__
+            else:
+                outData, outDType = pack(data)
+            if outDType in ("tensor", "packed_list", "packed_tuple"):
+                dataset = self._createArray(position, name, outData)
             else:
-                raise ValueError("Invalid data type for serialization")
-            return outData, outDType
-        def recursiveInsert(position, data):
-            print(position, data)
-            if isinstance(data, dict):
-                for key in data.keys():
-                    if isinstance(key, int):
-                        newKey = "__int__" + str(key)
-                    elif isinstance(key, str):
-                        if key.startswith("__int__"):
-                            raise ValueError("Keys starting with __int__ are reserved for internal use")
-                        elif key == "__emptyString__":
-                            raise ValueError("__emptyString__ is reserved for internal use")
-                        elif key == "":
-                            newKey = "__emptyString__"
+                dataset = position.create_dataset(name, data=outData)
+            dataset.attrs["type"] = outDType
+            if outDType in ("packed_list", "packed_tuple"):
+                dataset.attrs["elem_type"] = elemType
+            if outDType == "tensor" or outDType in ("packed_list", "packed_tuple") and elemType == "tensor":
+                dtype = data.dtype if outDType == "tensor" else data[0].dtype
+                for key, value in _dtypeHints(dtype, self.tensorStorageDtype).items():
+                    dataset.attrs[key] = value
+        def clear(position, name, path, linkType):
+            # removes the value a previous call stored under name, which would otherwise shadow the new one when loading.
+            # linkType is the class of the existing link, or None if there is none.
+            if linkType is not None:
+                del position[name]
+                if linkType is h5py.Group and packedPaths:
+                    prefix = path + "/"
+                    stale.update(i for i in packedPaths if i.startswith(prefix))
+            elif not _removeScalar(position, name) and path in packedPaths:
+                stale.add(path)
+        def collectTensors(data):
+            tensors = []
+            stack = [data]
+            while stack:
+                data = stack.pop()
+                if isinstance(data, dict):
+                    stack.extend(data.values())
+                elif isinstance(data, list) or isinstance(data, tuple):
+                    stack.extend(data)
+                elif isinstance(data, torch.Tensor) and data.device.type != "cpu":
+                    tensors.append(data)
+            return tensors
+        rootType = _containerType(dictionary)
+        if rootType is not None:
+            self.group.attrs["type"] = rootType
+        # copy all tensors residing on other devices to the CPU in a single batch before writing anything
+        tensors = collectTensors(dictionary)
+        staged = {}
+        cudaTensors = [i for i in tensors if i.is_cuda]
+        tensors = [i for i in tensors if not i.is_cuda]
+        if cudaTensors:
+            # CUDA tensors are staged in one pinned host buffer, so all copies can run asynchronously with a single synchronization
+            sizes = [i.numel() * i.element_size() for i in cudaTensors]
+            offsets = np.cumsum([0] + [(i + 63) // 64 * 64 for i in sizes])
+            buffer = torch.empty(int(offsets[-1]), dtype=torch.uint8, pin_memory=True)
+            for tensor, size, offset in zip(cudaTensors, sizes, offsets):
+                target = buffer[offset:offset + size].view(tensor.dtype).view(tensor.shape)
+                target.copy_(tensor.detach(), non_blocking=True)
+                staged[id(tensor)] = target
+            for i in set(i.device for i in cudaTensors):
+                torch.cuda.synchronize(i)
+        if tensors:
+            cpuTensors = [torch.empty_like(i, device="cpu", memory_format=torch.contiguous_format) for i in tensors]
+            torch._foreach_copy_(cpuTensors, [i.detach() for i in tensors])
+            staged.update({id(i): j for i, j in zip(tensors, cpuTensors)})
+        if self.compression == "gzip" and self.writeThreads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.writeThreads)
+        try:
+            # tensors packed by previous calls are dropped from the layouts when something else is written to their path
+            packedGroup = self.group.get("__packed__")
+            packedLayouts = {} if packedGroup is None else {i: json.loads(j["layout"][()]) for i, j in packedGroup.items()}
+            packedPaths = {i for layout in packedLayouts.values() for i in layout}
+            stale = set()
+            # the tree is walked with an explicit stack instead of recursion, so arbitrarily deep structures can be stored
+            smallTensors = {}
+            stack = [(self.group, dictionary, "")]
+            while stack:
+                position, data, path = stack.pop()
+                if self.verbose:
+                    print(position, data)
+                for name, value in _children(data):
+                    if self.verbose:
+                        print("key:", name)
+                    containerType = _containerType(value)
+                    childPath = _joinPath(path, name)
+                    if containerType is None:
+                        clear(position, name, childPath, position.get(name, getclass=True))
+                        if self.packSmallTensors and isinstance(value, torch.Tensor) and value.numel() * value.element_size() <= compressionThreshold:
+                            smallTensors.setdefault(value.dtype, []).append((childPath, value))
                         else:
-                            newKey = key
+                            write(position, name, value)
                     else:
-                        raise ValueError("Keys must be strings or ints")
-                    print("key:", key)
-                    if isinstance(data[key], dict):
-                        if newKey not in position:
-                            position.create_group(newKey)
-                            position[newKey].attrs["type"] = "dict"
-                        recursiveInsert(position[newKey], data[key])
-                    elif isinstance(data[key], list):
-                        if newKey not in position:
-                            position.create_group(newKey)
-                            position[newKey].attrs["type"] = "list"
-                        recursiveInsert(position[newKey], data[key])
-                    elif isinstance(data[key], tuple):
-                        if newKey not in position:
-                            position.create_group(newKey)
-                            position[newKey].attrs["type"] = "tuple"
-                        recursiveInsert(position[newKey], data[key])
-                    else:
-                        outData, outDType = pack(data[key])
-                        position.create_dataset(newKey, data=outData)
-                        position[newKey].attrs["type"] = outDType
-            elif isinstance(data, list) or isinstance(data, tuple):
-                for idx, i in enumerate(data):
-                    print("key:", str(idx))
-                    if isinstance(i, dict):
-                        if str(idx) not in position:
-                            position.create_group(str(idx))
-                            position[str(idx)].attrs["type"] = "dict"
-                        recursiveInsert(position[str(idx)], i)
-                    elif isinstance(i, list):
-                        if str(idx) not in position:
-                            position.create_group(str(idx))
-                            position[str(idx)].attrs["type"] = "list"
-                        recursiveInsert(position[str(idx)], i)
-                    elif isinstance(i, tuple):
-                        if str(idx) not in position:
-                            position.create_group(str(idx))
-                            position[str(idx)].attrs["type"] = "tuple"
-                        recursiveInsert(position[str(idx)], i)
-                    else:
-                        outData, outDType = pack(i)
-                        position.create_dataset(str(idx), data = outData)
-                        position[str(idx)].attrs["type"] = outDType
-        if isinstance(dictionary, dict):
-            self.group.attrs["type"] = "dict"
-        elif isinstance(dictionary, list):
-            self.group.attrs["type"] = "list"
-        elif isinstance(dictionary, tuple):
-            self.group.attrs["type"] = "tuple"
-        recursiveInsert(self.group, dictionary)
+                        group = position.get(name)
+                        if not isinstance(group, h5py.Group):
+                            # a leaf stored under the same name by a previous call is replaced by the container
+                            clear(position, name, childPath, None if group is None else h5py.Dataset)
+                            group = None
+                        if group is None and containerType != "dict" and isPackable(value):
+                            write(position, name, value)
+                        else:
+                            if group is None:
+                                # no creation order index is needed, since toDict restores the order of sequences from the element names
+                                group = position.create_group(name, track_order=False)
+                                group.attrs["type"] = containerType
+                            stack.append((group, value, childPath))
+            # small tensors are concatenated into one dataset per dtype, with a layout mapping their paths to offsets and shapes.
+            # Tensors packed by previous calls are kept, unless they are overwritten by this call. The data is rebuilt from the
+            # entries still in use, so the space of overwritten, inserted and deleted tensors is released.
+            if smallTensors or stale:
+                if packedGroup is None:
+                    packedGroup = self.group.create_group("__packed__", track_order=False)
+                written = stale
+                arrays = {}
+                for dtype, tensors in smallTensors.items():
+                    dtypeHints = _dtypeHints(dtype, self.tensorStorageDtype)
+                    dtypeName = str(dtype)[6:]
+                    if dtypeHints:
+                        dtypeName += "_as_" + dtypeHints["storage_dtype"]
+                    if dtypeName not in packedGroup:
+                        group = packedGroup.create_group(dtypeName, track_order=False)
+                        for key, value in dtypeHints.items():
+                            group.attrs[key] = value
+                    arrays[dtypeName] = [(tensorPath, pack(i)[0]) for tensorPath, i in tensors]
+                    written.update(tensorPath for tensorPath, _ in tensors)
+                for dtypeName, group in list(packedGroup.items()):
+                    entries = []
+                    if dtypeName in packedLayouts:
+                        # a tensor may also have been packed with a different dtype before, and insert and delete only
+                        # remove entries from the layout, so groups without new tensors are rewritten if they contain unused data
+                        live = [i for i in packedLayouts[dtypeName].items() if i[0] not in written]
+                        if dtypeName not in arrays and sum(int(np.prod(shape)) for _, (_, shape) in live) == group["data"].shape[0]:
+                            continue
+                        data = group["data"][()]
+                        entries = [(tensorPath, data[offset:offset + int(np.prod(shape))].reshape(shape)) for tensorPath, (offset, shape) in live]
+                        del group["layout"], group["data"]
+                    entries += arrays.get(dtypeName, [])
+                    if not entries:
+                        del packedGroup[dtypeName]
+                        continue
+                    layout = {}
+                    offset = 0
+                    for tensorPath, array in entries:
+                        layout[tensorPath] = [offset, list(array.shape)]
+                        offset += array.size
+                    self._createArray(group, "data", np.concatenate([i.ravel() for _, i in entries]))
+                    group.create_dataset("layout", data=json.dumps(layout).encode("utf-8"))
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
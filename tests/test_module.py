@@ -0,0 +1,399 @@
+import collections
+import concurrent.futures
+import enum
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from state_dict_to_h5.module import DictStorage, parallelChunkSize
+
+requiresCuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+
+
+def assertEqual(a, b):
+    """recursively compares two data structures, requiring tensors to match exactly in dtype, shape and values."""
+    if isinstance(a, torch.Tensor):
+        assert isinstance(b, torch.Tensor)
+        assert a.dtype == b.dtype and a.shape == b.shape
+        assert torch.equal(a, b)
+    elif isinstance(a, dict):
+        assert isinstance(b, dict) and a.keys() == b.keys()
+        for key in a:
+            assertEqual(a[key], b[key])
+    elif isinstance(a, (list, tuple)):
+        assert type(a) == type(b) and len(a) == len(b)
+        for x, y in zip(a, b):
+            assertEqual(x, y)
+    else:
+        assert type(a) == type(b) and a == b
+
+
+def roundTrip(path, data, **kwargs):
+    with h5py.File(path, "w") as file:
+        DictStorage(file, ["model"], **kwargs).fromDict(data)
+    with h5py.File(path, "r") as file:
+        return DictStorage(file, ["model"]).toDict()
+
+
+def sampleDict():
+    return {
+        "weight": torch.randn(300, 200),
+        "bias": torch.randn(200),
+        "empty": torch.zeros(0),
+        "scalar": torch.tensor(3.0),
+        "mask": torch.ones(3, dtype=torch.bool),
+        "half": torch.randn(4, 4).half(),
+        "": "empty key",
+        3: "int key",
+        "ints": [1, 2, 3],
+        "floats": (1.5, 2.5),
+        "mixed": [1, "a", None, True, (2, 3.0)],
+        "tensors": [torch.randn(5), torch.randn(5)],
+        "nested": {"a": {"b": {"c": 1}}},
+        "none": None,
+        "emptyList": [],
+        "emptyDict": {},
+        "x": 1.0,
+        "flag": False,
+        "text": "héllo",
+    }
+
+
+def test_roundTrip(tmp_path):
+    data = sampleDict()
+    assertEqual(roundTrip(tmp_path / "test.h5", data), data)
+
+
+def test_roundTripSequenceRoot(tmp_path):
+    data = [sampleDict(), 1, (2, "b")]
+    assertEqual(roundTrip(tmp_path / "test.h5", data), data)
+
+
+def test_longSequenceOrder(tmp_path):
+    data = {"list": list(range(25)), "tuple": tuple((i, [i, "x"]) for i in range(12))}
+    assertEqual(roundTrip(tmp_path / "test.h5", data), data)
+
+
+def test_deepNesting(tmp_path):
+    data = current = {}
+    for _ in range(3000):
+        current["n"] = {}
+        current = current["n"]
+    current["v"] = 1
+    out = roundTrip(tmp_path / "test.h5", data)
+    depth = 0
+    while "n" in out:
+        out = out["n"]
+        depth += 1
+    assert depth == 3000 and out == {"v": 1}
+
+
+def test_packedSequences(tmp_path):
+    data = {"ints": [1, 2], "floats": (1.0, 2.0), "bools": [True], "tensors": [torch.ones(2, 3), torch.zeros(2, 3)], "mixed": [1, True]}
+    path = tmp_path / "test.h5"
+    assertEqual(roundTrip(path, data), data)
+    with h5py.File(path, "r") as file:
+        group = file["model"]
+        assert group["ints"].attrs["type"] == "packed_list" and group["ints"].attrs["elem_type"] == "int"
+        assert group["floats"].attrs["type"] == "packed_tuple"
+        assert group["tensors"].attrs["elem_type"] == "tensor"
+        assert isinstance(group["mixed"], h5py.Group)
+
+
+def test_largeTensorSequences(tmp_path):
+    data = {"layers": [torch.randn(300, 300)] * 3}
+    path = tmp_path / "test.h5"
+    assertEqual(roundTrip(path, data), data)
+    with h5py.File(path, "r") as file:
+        assert isinstance(file["model/layers"], h5py.Group) and file["model/layers/0"].shape == (300, 300)
+
+
+def test_scalarAttributes(tmp_path):
+    data = {"type": 1, "lr": 0.1, "flag": True, "many": {str(i): i for i in range(200)}}
+    path = tmp_path / "test.h5"
+    assertEqual(roundTrip(path, data), data)
+    with h5py.File(path, "r") as file:
+        group = file["model"]
+        assert group.attrs["type"] == "dict"
+        assert group.attrs["__type__type"] == "int" and group.attrs["__value__type"] == 1
+        assert "lr" not in group
+        storage = DictStorage(file, ["model"])
+        assert storage.fetch(["lr"]) == 0.1
+
+
+def test_packSmallTensors(tmp_path):
+    data = {"bn": {"mean": torch.randn(8), "var": torch.randn(8), "count": torch.tensor(3)},
+            "list": [torch.randn(2), 1, "x", torch.ones(3, dtype=torch.bool)], "big": torch.randn(200, 200)}
+    path = tmp_path / "test.h5"
+    with h5py.File(path, "w") as file:
+        storage = DictStorage(file, ["model"], packSmallTensors=True)
+        storage.fromDict(data)
+        assert sorted(file["model/__packed__"]) == ["bool", "float32", "int64"]
+        assert "mean" not in file["model/bn"]
+        assertEqual(storage.toDict(), data)
+        assert np.array_equal(storage.fetch(["bn", "mean"]), data["bn"]["mean"].numpy())
+        storage.fromDict({"extra": torch.arange(4)})
+        assertEqual(storage.toDict(), dict(data, extra=torch.arange(4)))
+        storage.delete(["bn", "var"])
+        assert sorted(storage.toDict()["bn"]) == ["count", "mean"]
+
+
+@pytest.mark.parametrize("storageDtype", [torch.float16, torch.bfloat16])
+def test_halfPrecisionStorage(tmp_path, storageDtype):
+    data = {"weight": torch.randn(300, 300), "bias": torch.randn(5), "double": torch.randn(3).double(), "list": [torch.randn(2), torch.randn(2)]}
+    out = roundTrip(tmp_path / "test.h5", data, tensorStorageDtype=storageDtype)
+    for key in ("weight", "bias", "double"):
+        assert out[key].dtype == data[key].dtype
+        assert torch.allclose(out[key], data[key], rtol=1e-2, atol=1e-2)
+    assert out["list"][0].dtype == torch.float32
+    assert torch.equal(out["double"], data["double"])
+
+
+@pytest.mark.parametrize("packSmallTensors", [False, True])
+def test_bfloat16Tensors(tmp_path, packSmallTensors):
+    data = {"weight": torch.randn(300, 300).bfloat16(), "bias": torch.randn(4).bfloat16(), "scalar": torch.tensor(1.5, dtype=torch.bfloat16),
+            "list": [torch.randn(2).bfloat16()] * 2}
+    path = tmp_path / "test.h5"
+    assertEqual(roundTrip(path, data, packSmallTensors=packSmallTensors), data)
+    with h5py.File(path, "r") as file:
+        assert file["model/weight"].dtype == np.int16
+        assert file["model/weight"].attrs["storage_dtype"] == "bfloat16"
+
+
+def test_insertInPlace(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, ["model"])
+        storage.insert(["a", "b"], np.arange(3))
+        dataset = file["model/a/b"]
+        storage.insert(["a", "b"], np.arange(3) + 1)
+        assert file["model/a/b"].id == dataset.id
+        assert np.array_equal(storage.fetch(["a", "b"]), np.arange(3) + 1)
+        storage.insert(["a", "b"], np.zeros(5))
+        assert np.array_equal(storage.fetch(["a", "b"]), np.zeros(5))
+        storage.delete(["a", "b"])
+        with pytest.raises(KeyError):
+            storage.fetch(["a", "b"])
+
+
+@pytest.mark.parametrize("shape, dtype", [((1000, 333), np.float64), ((70000,), np.float32), ((3, 5000, 7), np.float64),
+                                          ((5000, 40), np.bool_), ((300000,), np.int16), ((2, 600000), np.float64)])
+def test_parallelGzip(tmp_path, shape, dtype):
+    array = (np.random.rand(*shape) * 100).astype(dtype)
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        DictStorage(file, compression="gzip", writeThreads=4).insert(["a"], array)
+    with h5py.File(tmp_path / "test.h5", "r") as file:
+        dataset = file["a"]
+        assert dataset.compression == "gzip" and dataset.shuffle
+        assert dataset.chunks[0] * dataset[0].nbytes <= max(parallelChunkSize, dataset[0].nbytes)
+        assert dataset.dtype == array.dtype and np.array_equal(dataset[()], array)
+
+
+def test_parallelGzipRoundTrip(tmp_path):
+    data = sampleDict()
+    assertEqual(roundTrip(tmp_path / "test.h5", data, compression="gzip", writeThreads=3), data)
+
+
+def test_openAndRepack(tmp_path):
+    path = str(tmp_path / "test.h5")
+    data = sampleDict()
+    storage = DictStorage.open(path, "w", groups=["model"])
+    storage.fromDict(data)
+    for i in range(5):
+        storage.insert(["extra"], np.random.rand(100 + i, 300))
+    storage.delete(["extra"])
+    storage.close()
+    DictStorage.repack(path)
+    storage = DictStorage.open(path, "r", groups=["model"])
+    assertEqual(storage.toDict(), data)
+    storage.close()
+
+
+def test_insertInPlaceDropsDtypeHints(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, tensorStorageDtype=torch.bfloat16)
+        storage.fromDict({"w": torch.randn(3)})
+        storage.insert(["w"], np.array([1, 2, 3], np.int16))
+        assert "storage_dtype" not in file["w"].attrs and "torch_dtype" not in file["w"].attrs
+        assertEqual(storage.toDict(), {"w": torch.tensor([1, 2, 3], dtype=torch.int16)})
+
+
+@pytest.mark.parametrize("first, second", [(1, torch.ones(2)), (torch.ones(2), 1), (1, {"a": 2}), ({"a": 2}, 1.5), (1, "text")])
+def test_overwriteScalarWithDataset(tmp_path, first, second):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file)
+        storage.fromDict({"x": first})
+        storage.fromDict({"x": second})
+        assert not ("x" in file and "__type__x" in file.attrs)
+        assertEqual(storage.toDict(), {"x": second})
+
+
+def test_parallelGzipSharedPool(tmp_path, monkeypatch):
+    pools = []
+    executor = concurrent.futures.ThreadPoolExecutor
+    def createPool(*args, **kwargs):
+        pools.append(executor(*args, **kwargs))
+        return pools[-1]
+    monkeypatch.setattr(concurrent.futures, "ThreadPoolExecutor", createPool)
+    data = {"a": torch.randn(300, 300), "b": torch.randn(500, 100), "c": [torch.randn(200, 200)] * 2}
+    assertEqual(roundTrip(tmp_path / "test.h5", data, compression="gzip", writeThreads=2), data)
+    assert len(pools) == 1
+    with pytest.raises(RuntimeError):
+        pools[0].submit(print)
+
+
+def test_packedOverwrite(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, packSmallTensors=True)
+        data = {"a": torch.randn(8), "b": {"c": torch.randn(4)}}
+        storage.fromDict(data)
+        for _ in range(3):
+            data["a"] = torch.randn(8)
+            storage.fromDict({"a": data["a"]})
+        assert file["__packed__/float32/data"].shape == (12,)
+        assertEqual(storage.toDict(), data)
+        storage.fromDict({"a": torch.arange(3)})
+        assert file["__packed__/float32/data"].shape == (4,)
+        assertEqual(storage.toDict(), {"a": torch.arange(3), "b": data["b"]})
+        storage.delete(["b", "c"])
+        storage.fromDict({"a": torch.arange(5)})
+        assert "float32" not in file["__packed__"]
+        assertEqual(storage.toDict(), {"a": torch.arange(5), "b": {}})
+
+
+def test_subclassLeaves(tmp_path):
+    class Mode(enum.IntEnum):
+        TRAIN = 2
+    data = collections.OrderedDict(mode=Mode.TRAIN, state=collections.OrderedDict(w=torch.ones(2)), flag=True)
+    out = roundTrip(tmp_path / "test.h5", data)
+    assertEqual(out, {"mode": 2, "state": {"w": torch.ones(2)}, "flag": True})
+
+
+@pytest.mark.parametrize("storageDtype", [torch.float64, torch.int8, "float16"])
+def test_invalidStorageDtype(tmp_path, storageDtype):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        with pytest.raises(ValueError):
+            DictStorage(file, tensorStorageDtype=storageDtype)
+
+
+@pytest.mark.parametrize("first, second", [({"a": 1}, {"a": torch.ones(2)}), ({"a": torch.randn(200, 200)}, {"a": torch.ones(2)}),
+                                           ({"a": torch.ones(2)}, {"a": torch.randn(200, 200)}), ({"a": torch.ones(2)}, {"a": 1}),
+                                           ({"l": [torch.ones(2), 5]}, {"l": [1, 5]}), ({"a": {"b": torch.ones(2)}}, {"a": 1})])
+def test_packedOverwriteOtherKinds(tmp_path, first, second):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, packSmallTensors=True)
+        storage.fromDict(first)
+        storage.fromDict(second)
+        assertEqual(storage.toDict(), second)
+        storage.fromDict(first)
+        assertEqual(storage.toDict(), first)
+
+
+def test_deleteRecursive(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, packSmallTensors=True)
+        storage.fromDict({"x": 1, "y": 2})
+        storage.delete(["x"], recursive=True)
+        assertEqual(storage.toDict(), {"y": 2})
+        storage.fromDict({"a": {"b": {"c": torch.randn(300, 300)}, "d": 1}, "e": {"f": {"g": torch.ones(2), "h": torch.randn(300, 300)}}})
+        storage.delete(["a", "b", "c"], recursive=True)
+        storage.delete(["e", "f", "h"], recursive=True)
+        assertEqual(storage.toDict(), {"y": 2, "a": {"d": 1}, "e": {"f": {"g": torch.ones(2)}}})
+        storage.delete(["e", "f", "g"], recursive=True)
+        storage.delete(["y"], recursive=True)
+        assertEqual(storage.toDict(), {"a": {"d": 1}})
+
+
+@pytest.mark.parametrize("packSmallTensors", [False, True])
+def test_overwriteDatasetWithContainer(tmp_path, packSmallTensors):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, packSmallTensors=packSmallTensors)
+        for value in (torch.ones(2), {"b": 1, "c": 2.0}, "text", [1, "x"], None, [1, 2]):
+            storage.fromDict({"a": value})
+            assertEqual(storage.toDict(), {"a": value})
+
+
+def test_verbose(tmp_path, capsys):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        DictStorage(file).fromDict({"a": {"b": 1}})
+        assert capsys.readouterr().out == ""
+        DictStorage(file, verbose=True).fromDict({"a": {"b": 1}})
+        out = capsys.readouterr().out
+        assert "key: a" in out and "key: b" in out
+
+
+@pytest.mark.parametrize("key", ["__int__1", "__int__x", "__emptyString__", "__packed__", 1.5])
+def test_invalidKeys(tmp_path, key):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        with pytest.raises(ValueError):
+            DictStorage(file).fromDict({"a": {key: 1}})
+
+
+def test_keyMangling(tmp_path):
+    data = {3: "int", "3": "str", -1: [1, 2], "": {"": 0}, "__int": 1.0}
+    assertEqual(roundTrip(tmp_path / "test.h5", data), data)
+
+
+@requiresCuda
+@pytest.mark.parametrize("tensorStorageDtype", [None, torch.bfloat16])
+def test_cudaStaging(tmp_path, tensorStorageDtype):
+    data = {"weight": torch.randn(300, 300, device="cuda"), "transposed": torch.randn(40, 30, device="cuda").t(),
+            "grad": torch.nn.Parameter(torch.randn(5, device="cuda")), "half": torch.randn(7, device="cuda").half(),
+            "cpu": torch.randn(3), "list": [torch.randn(2, device="cuda"), torch.randn(2, device="cuda")]}
+    out = roundTrip(tmp_path / "test.h5", data, tensorStorageDtype=tensorStorageDtype)
+    expected = {key: value.detach().cpu() if isinstance(value, torch.Tensor) else [i.cpu() for i in value] for key, value in data.items()}
+    if tensorStorageDtype is None:
+        assertEqual(out, expected)
+    else:
+        assert out["weight"].dtype == torch.float32 and torch.allclose(out["weight"], expected["weight"], rtol=1e-2, atol=1e-2)
+        assertEqual(out["half"], expected["half"])
+
+
+@requiresCuda
+@pytest.mark.parametrize("packSmallTensors", [False, True])
+def test_cudaLoading(tmp_path, packSmallTensors):
+    data = {"weight": torch.randn(300, 300), "empty": torch.zeros(0, 3), "bf16": torch.randn(4).bfloat16(),
+            "ints": torch.arange(6).reshape(2, 3), "list": [torch.randn(2), torch.randn(2)], "nested": {"x": torch.randn(5), "y": 1}}
+    path = tmp_path / "test.h5"
+    with h5py.File(path, "w") as file:
+        DictStorage(file, packSmallTensors=packSmallTensors).fromDict(data)
+    with h5py.File(path, "r") as file:
+        out = DictStorage(file, torchDevice="cuda").toDict()
+    for key in ("weight", "empty", "bf16", "ints"):
+        assert out[key].is_cuda
+        assertEqual(out[key].cpu(), data[key])
+    assertEqual([i.cpu() for i in out["list"]], data["list"])
+    assertEqual(out["nested"]["x"].cpu(), data["nested"]["x"])
+    assert out["nested"]["y"] == 1
+
+
+def test_tensorLayouts(tmp_path):
+    base = torch.randn(20, 30)
+    data = {"transposed": base.t(), "slice": base[::2, 5:], "parameter": torch.nn.Parameter(torch.randn(4)), "expanded": torch.ones(3).expand(4, 3)}
+    out = roundTrip(tmp_path / "test.h5", data)
+    assertEqual(out, {key: value.detach().contiguous() for key, value in data.items()})
+
+
+@pytest.mark.parametrize("compression", ["lzf", "gzip", None])
+def test_compressionThreshold(tmp_path, compression):
+    data = {"large": torch.zeros(300, 300), "small": torch.zeros(100)}
+    path = tmp_path / "test.h5"
+    assertEqual(roundTrip(path, data, compression=compression, writeThreads=1), data)
+    with h5py.File(path, "r") as file:
+        assert file["model/large"].compression == compression and file["model/large"].shuffle == (compression is not None)
+        assert file["model/small"].compression is None and file["model/small"].chunks is None
+
+
+def test_missingKeys(tmp_path):
+    with h5py.File(tmp_path / "test.h5", "w") as file:
+        storage = DictStorage(file, ["a", "b"])
+        storage.fromDict({"c": {"d": 1}})
+        assert DictStorage(file, ["a", "b"]).fetch(["c", "d"]) == 1
+        for keys in (["x", "d"], ["c", "x"], ["c", "d", "e"]):
+            with pytest.raises(KeyError):
+                storage.fetch(keys)
+        with pytest.raises(KeyError):
+            storage.delete(["c", "x"])
+        with pytest.raises(KeyError):
+            storage.delete(["x", "d"])